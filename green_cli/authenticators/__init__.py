@@ -31,6 +31,9 @@ class Authenticator:
     def register(self, session):
         return gdk.register_user(session, self.hw_device, self.mnemonic)
 
+    def wipe(self):
+        """Forget any key material cached by the authenticator, e.g. on logout"""
+
 
 class ConfigProperty:
     """A piece of data that is stored in a file in the config directory"""
@@ -2,7 +2,31 @@ import wallycore as wally
 
 from green_cli.authenticators import *
 
+import atexit
+import functools
 import secrets
+import threading
+
+from typing import Tuple
+
+# Flags for computing signature hashes, all supported inputs are segwit
+_SIGHASH_TX_FLAGS = wally.WALLY_TX_FLAG_USE_WITNESS
+
+_SEGWIT_SCRIPT_TYPES = frozenset([14, 15, 159, 162])
+
+@functools.lru_cache(maxsize=256)
+def _bytes_from_hex(hex_str: str) -> bytes:
+    """Decode hex, caching results since scripts and commitments repeat when re-signing"""
+    return bytes.fromhex(hex_str)
+
+@functools.lru_cache(maxsize=256)
+def _confidential_value_from_satoshi(satoshi: int) -> bytes:
+    return bytes(wally.tx_confidential_value_from_satoshi(satoshi))
+
+def _dump_sign_tx_result(result: Dict) -> str:
+    """Serialize a sign_tx result, which can be large, as compact json"""
+    # The result only contains hex strings so there is nothing to escape
+    return json.dumps(result, ensure_ascii=False, separators=(',', ':'))
 
 class WallyAuthenticator(MnemonicOnDisk, HardwareDevice):
     """Stores mnemonic on disk but does not pass it to the gdk
@@ -12,6 +36,39 @@ class WallyAuthenticator(MnemonicOnDisk, HardwareDevice):
     gdk at all.
     """
 
+    def __init__(self, options):
+        super().__init__(options)
+
+        # Guards the cached key material, which can be wiped from the gdk notification thread
+        self._key_lock = threading.RLock()
+        self._clear_key_cache()
+        atexit.register(self.wipe)
+
+        # The gdk may ask to sign the same transaction again, e.g. after a failed send, so keep
+        # the most recently parsed transactions rather than parsing the hex every time.
+        # Only for transactions that are never modified, as the cache shares the wally tx.
+        self._tx_from_hex = functools.lru_cache(maxsize=8)(wally.tx_from_hex)
+
+        # The gdk says per request whether to use anti-exfil, so bind both input signers up front
+        self._input_signers = {True: self._sign_input_ae, False: self._sign_input_ecdsa}
+
+    def _clear_key_cache(self):
+        """Forget the seed and any keys derived from it"""
+        with self._key_lock:
+            self._seed = None
+            self._master_key = None
+            self._derive_key_cached = functools.lru_cache(maxsize=256)(self._derive_key)
+
+    def wipe(self):
+        """Overwrite the cached seed and forget the master key and all derived keys
+
+        The seed is derived again from the mnemonic if it is needed after this, e.g. on login.
+        """
+        with self._key_lock:
+            if self._seed is not None:
+                self._seed[:] = bytes(len(self._seed))
+            self._clear_key_cache()
+
     @property
     def name(self):
         return 'libwally software signer'
@@ -39,24 +96,38 @@ class WallyAuthenticator(MnemonicOnDisk, HardwareDevice):
         assert len(mnemonic.split()) == words
 
         self._mnemonic = mnemonic
+        self.wipe()
         return self.register(session_obj)
 
     @property
     def seed(self):
-        _, seed = wally.bip39_mnemonic_to_seed512(self._mnemonic, None)
-        return seed
+        # bip39 seed derivation is deliberately expensive (pbkdf2), so only do it once.
+        # wipe() overwrites the returned buffer, so only use it while holding _key_lock.
+        with self._key_lock:
+            if self._seed is None:
+                _, self._seed = wally.bip39_mnemonic_to_seed512(self._mnemonic, None)
+            return self._seed
 
     @property
     def master_key(self):
-        return wally.bip32_key_from_seed(self.seed, wally.BIP32_VER_TEST_PRIVATE,
-                                         wally.BIP32_FLAG_KEY_PRIVATE)
+        with self._key_lock:
+            if self._master_key is None:
+                self._master_key = wally.bip32_key_from_seed(
+                    self.seed, wally.BIP32_VER_TEST_PRIVATE, wally.BIP32_FLAG_KEY_PRIVATE)
+            return self._master_key
 
-    def derive_key(self, path: List[int]):
+    def _derive_key(self, path: Tuple[int, ...]):
         if not path:
             return self.master_key
         else:
-            return wally.bip32_key_from_parent_path(self.master_key, path,
-                                                    wally.BIP32_FLAG_KEY_PRIVATE)
+            # Paths usually share a long prefix (e.g. subaccount and branch), so derive from the
+            # cached parent key rather than all the way from the master key
+            parent = self._derive_key_cached(path[:-1])
+            return wally.bip32_key_from_parent(parent, path[-1], wally.BIP32_FLAG_KEY_PRIVATE)
+
+    def derive_key(self, path: List[int]):
+        # Inputs commonly share paths (e.g. change), so cache derived keys by path
+        return self._derive_key_cached(tuple(path))
 
     def get_xpub(self, path: List[int]):
         return wally.bip32_key_to_base58(self.derive_key(path), wally.BIP32_FLAG_KEY_PUBLIC)
@@ -97,53 +168,62 @@ class WallyAuthenticator(MnemonicOnDisk, HardwareDevice):
         return result
 
     def _get_sighash(self, wally_tx, index, utxo):
-        flags = wally.WALLY_TX_FLAG_USE_WITNESS
-        prevout_script = wally.hex_to_bytes(utxo['prevout_script'])
+        prevout_script = _bytes_from_hex(utxo['prevout_script'])
         return wally.tx_get_btc_signature_hash(
-                wally_tx, index, prevout_script, utxo['satoshi'], wally.WALLY_SIGHASH_ALL, flags)
+                wally_tx, index, prevout_script, utxo['satoshi'], wally.WALLY_SIGHASH_ALL,
+                _SIGHASH_TX_FLAGS)
+
+    @staticmethod
+    def _der_with_sighash(signature) -> str:
+        """Return hex der encoded signature with the sighash byte appended"""
+        signature = wally.ec_sig_to_der(signature)
+        signature.append(wally.WALLY_SIGHASH_ALL)
+        signature = signature.hex()
+        logging.debug('Signature (der): %s', signature)
+        return signature
+
+    def _sign_input_ae(self, txhash, utxo):
+        """Return the signer commitment and anti-exfil signature for a single input"""
+        privkey = self.get_privkey(utxo['user_path'])
+        signer_commitment, signature = self._make_ae_signature(privkey, txhash, utxo)
+
+        signer_commitment = signer_commitment.hex()
+        logging.debug('Signer commitment: %s', signer_commitment)
+        return signer_commitment, self._der_with_sighash(signature)
+
+    def _sign_input_ecdsa(self, txhash, utxo):
+        """Return no signer commitment and a plain ecdsa signature for a single input"""
+        privkey = self.get_privkey(utxo['user_path'])
+        signature = wally.ec_sig_from_bytes(privkey, txhash,
+                                            wally.EC_FLAG_ECDSA | wally.EC_FLAG_GRIND_R)
+        return None, self._der_with_sighash(signature)
 
     def _sign_tx(self, details, wally_tx):
-        txdetails = details['transaction']
         utxos = details['signing_inputs']
         use_ae_protocol = details['use_ae_protocol']
 
-        signatures = []
-        signer_commitments = []
+        is_segwit = all(utxo['script_type'] in _SEGWIT_SCRIPT_TYPES for utxo in utxos)
+        if not is_segwit:
+            # FIXME
+            raise NotImplementedError("Non-segwit input")
+
+        get_sighash = self._get_sighash
+        sign_input = self._input_signers[bool(use_ae_protocol)]
+        signed = []
         for index, utxo in enumerate(utxos):
-            is_segwit = utxo['script_type'] in [14, 15, 159, 162] # FIXME!!
-            if not is_segwit:
-                # FIXME
-                raise NotImplementedError("Non-segwit input")
-
-            txhash = self._get_sighash(wally_tx, index, utxo)
-            path = utxo['user_path']
-            privkey = self.get_privkey(path)
-            logging.debug('Processing input %s, path %s', index, path)
-
-            if use_ae_protocol:
-                signer_commitment, signature = self._make_ae_signature(privkey, txhash, utxo)
-
-                signer_commitment = signer_commitment.hex()
-                logging.debug('Signer commitment: %s', signer_commitment)
-                signer_commitments.append(signer_commitment)
-            else:
-                signature = wally.ec_sig_from_bytes(privkey, txhash,
-                                                    wally.EC_FLAG_ECDSA | wally.EC_FLAG_GRIND_R)
-
-            signature = wally.ec_sig_to_der(signature)
-            signature.append(wally.WALLY_SIGHASH_ALL)
-            signature = signature.hex()
-            logging.debug('Signature (der): %s', signature)
-            signatures.append(signature)
+            logging.debug('Processing input %s, path %s', index, utxo['user_path'])
+            txhash = get_sighash(wally_tx, index, utxo)
+            signed.append(sign_input(txhash, utxo))
 
+        signer_commitments, signatures = map(list, zip(*signed)) if signed else ([], [])
         result = {'signer_commitments': signer_commitments} if use_ae_protocol else {}
         result['signatures'] = signatures
         return result
 
     def sign_tx(self, details: Dict):
         tx_flags = wally.WALLY_TX_FLAG_USE_WITNESS
-        wally_tx = wally.tx_from_hex(details['transaction']['transaction'], tx_flags)
-        return json.dumps(self._sign_tx(details, wally_tx))
+        wally_tx = self._tx_from_hex(details['transaction']['transaction'], tx_flags)
+        return _dump_sign_tx_result(self._sign_tx(details, wally_tx))
 
 
 class WallyAuthenticatorLiquid(WallyAuthenticator):
@@ -163,7 +243,8 @@ class WallyAuthenticatorLiquid(WallyAuthenticator):
 
     @property
     def master_blinding_key(self) -> bytes:
-        return wally.asset_blinding_key_from_seed(self.seed)
+        with self._key_lock:
+            return wally.asset_blinding_key_from_seed(self.seed)
 
     def get_private_blinding_key(self, script: bytes) -> bytes:
         return wally.asset_blinding_key_to_ec_private_key(self.master_blinding_key, script)
@@ -184,57 +265,84 @@ class WallyAuthenticatorLiquid(WallyAuthenticator):
             o['wally_index'] = i
 
         blinded_outputs = [o for o in txdetails['transaction_outputs'] if not o['is_fee']]
-        for output in blinded_outputs:
-            # TODO: the derivation dance
-            # the following values are in display order, reverse them when converting to bytes
-            output['assetblinder'] = os.urandom(32).hex()
-            output['amountblinder'] = os.urandom(32).hex()
+
+        # TODO: the derivation dance
+        # Draw all the random blinders at once and keep them as little-endian bytes
+        blinders = secrets.token_bytes(64 * len(blinded_outputs))
+        for i, output in enumerate(blinded_outputs):
+            output['_abf_le'] = blinders[i * 64:i * 64 + 32]
+            output['_vbf_le'] = blinders[i * 64 + 32:(i + 1) * 64]
+            output['_asset_le'] = bytes.fromhex(output['asset_id'])[::-1]
+
+        for utxo in utxos:
+            utxo['_abf_le'] = bytes.fromhex(utxo['assetblinder'])[::-1]
+            utxo['_vbf_le'] = bytes.fromhex(utxo['amountblinder'])[::-1]
 
         endpoints = utxos + blinded_outputs
         values = [endpoint['satoshi'] for endpoint in endpoints]
-        abfs = b''.join(bytes.fromhex(endpoint['assetblinder'])[::-1] for endpoint in endpoints)
-        vbfs = b''.join(bytes.fromhex(endpoint['amountblinder'])[::-1] for endpoint in endpoints[:-1])
+        abfs = bytearray(32 * len(endpoints))
+        vbfs = bytearray(32 * (len(endpoints) - 1))
+        for i, endpoint in enumerate(endpoints):
+            abfs[i * 32:(i + 1) * 32] = endpoint['_abf_le']
+        for i, endpoint in enumerate(endpoints[:-1]):
+            vbfs[i * 32:(i + 1) * 32] = endpoint['_vbf_le']
+
         final_vbf = wally.asset_final_vbf(values, len(utxos), abfs, vbfs)
-        blinded_outputs[-1]['amountblinder'] = final_vbf[::-1].hex()
+        blinded_outputs[-1]['_vbf_le'] = final_vbf
 
+        asset_generator_from_bytes = wally.asset_generator_from_bytes
+        asset_value_commitment = wally.asset_value_commitment
+        tx_set_output_asset = wally.tx_set_output_asset
+        tx_set_output_value = wally.tx_set_output_value
         for o in blinded_outputs:
-            asset_commitment = wally.asset_generator_from_bytes(bytes.fromhex(o['asset_id'])[::-1], bytes.fromhex(o['assetblinder'])[::-1])
-            value_commitment = wally.asset_value_commitment(o['satoshi'], bytes.fromhex(o['amountblinder'])[::-1], asset_commitment)
+            asset_commitment = asset_generator_from_bytes(o['_asset_le'], o['_abf_le'])
+            value_commitment = asset_value_commitment(o['satoshi'], o['_vbf_le'], asset_commitment)
 
+            # Only hex encode values once they are final, the blinders are returned in display
+            # order so are the reverse of the bytes
+            o['assetblinder'] = o['_abf_le'][::-1].hex()
+            o['amountblinder'] = o['_vbf_le'][::-1].hex()
             o['asset_commitment'] = asset_commitment.hex()
             o['value_commitment'] = value_commitment.hex()
 
             # Write the commitments into the wally tx for signing
-            wally.tx_set_output_asset(wally_tx, o['wally_index'], asset_commitment)
-            wally.tx_set_output_value(wally_tx, o['wally_index'], value_commitment)
-
-        retval = {}
-        for key in ['assetblinders', 'amountblinders', 'asset_commitments', 'value_commitments']:
-            # gdk expects to get an empty entry for the fee output too, hence this is over the
-            # transaction outputs, not just the blinded outputs (fee will just have empty
-            # strings)
-            retval[key] = [o.get(key[:-1], '') for o in txdetails['transaction_outputs']]
-        return retval
+            tx_set_output_asset(wally_tx, o['wally_index'], asset_commitment)
+            tx_set_output_value(wally_tx, o['wally_index'], value_commitment)
+
+        # gdk expects to get an empty entry for the fee output too, hence this is over the
+        # transaction outputs, not just the blinded outputs (fee will just have empty strings)
+        assetblinders, amountblinders, asset_commitments, value_commitments = [], [], [], []
+        for o in txdetails['transaction_outputs']:
+            assetblinders.append(o.get('assetblinder', ''))
+            amountblinders.append(o.get('amountblinder', ''))
+            asset_commitments.append(o.get('asset_commitment', ''))
+            value_commitments.append(o.get('value_commitment', ''))
+        return {
+            'assetblinders': assetblinders,
+            'amountblinders': amountblinders,
+            'asset_commitments': asset_commitments,
+            'value_commitments': value_commitments,
+        }
 
     def _get_sighash(self, wally_tx, index, utxo):
-        flags = wally.WALLY_TX_FLAG_USE_WITNESS
-        prevout_script = wally.hex_to_bytes(utxo['prevout_script'])
+        prevout_script = _bytes_from_hex(utxo['prevout_script'])
         if utxo['confidential']:
-            value = bytes.fromhex(utxo['commitment'])
+            value = _bytes_from_hex(utxo['commitment'])
         else:
-            value = wally.tx_confidential_value_from_satoshi(utxo['satoshi'])
+            value = _confidential_value_from_satoshi(utxo['satoshi'])
         return wally.tx_get_elements_signature_hash(
-            wally_tx, index, prevout_script, value, wally.WALLY_SIGHASH_ALL, flags)
+            wally_tx, index, prevout_script, value, wally.WALLY_SIGHASH_ALL, _SIGHASH_TX_FLAGS)
 
     def sign_tx(self, details):
         tx_flags = wally.WALLY_TX_FLAG_USE_WITNESS | wally.WALLY_TX_FLAG_USE_ELEMENTS
+        # Blinding writes the commitments into the tx, so always parse a fresh one
         wally_tx = wally.tx_from_hex(details['transaction']['transaction'], tx_flags)
 
         retval = {}
         retval.update(self._get_blinding_factors(details['transaction'], wally_tx))
         retval.update(self._sign_tx(details, wally_tx))
 
-        return json.dumps(retval)
+        return _dump_sign_tx_result(retval)
 
 
 def get_authenticator(options):
@@ -1,4 +1,5 @@
 import logging
+import sys
 import threading
 
 import greenaddress as gdk
@@ -10,16 +11,37 @@ class Session(gdk.Session):
     def __init__(self, net_params):
         self.current_block_height = None
         self.latest_events = {}
-        self.event_cv = threading.Condition()
+        self.event_flags = {}
         super().__init__(net_params)
 
+    def _event_flag(self, event_type):
+        """Return the threading.Event set once an event of event_type has been received"""
+        flag = self.event_flags.get(event_type)
+        if flag is None:
+            # setdefault is atomic so the waiter and callback threads always share the same flag
+            flag = self.event_flags.setdefault(event_type, threading.Event())
+        return flag
+
     def getlatestevent(self, event_type):
-        with self.event_cv:
-            self.event_cv.wait_for(lambda: event_type in self.latest_events)
+        self._event_flag(event_type).wait()
         return self.latest_events[event_type]
 
+    @staticmethod
+    def _wipe_authenticator():
+        """Drop any key material cached by the authenticator"""
+        try:
+            # This module is imported before green_cli.context replaces itself with the Context
+            # instance, so look the context up at call time rather than using the import
+            authenticator = sys.modules['green_cli.context'].authenticator
+            wipe = getattr(authenticator, 'wipe', None)
+            if wipe:
+                wipe()
+        except Exception as e:
+            logging.error("Error wiping authenticator: {}".format(str(e)))
+
     def callback_handler(self, event):
-        logging.debug("Callback received event: {}".format(event))
+        logging.debug("Callback received event: %s", event)
+        logged_out = False
         try:
             event_type = event['event']
             event_body = event[event_type]
@@ -27,16 +49,20 @@ class Session(gdk.Session):
             if event_type == 'network' and event_body.get('login_required', False):
                 logging.debug("Setting logged_in to false after network event")
                 context.logged_in = False
+                logged_out = True
 
             if event_type == 'block':
                 self.current_block_height = event_body['block_height']
-                logging.debug(f"Updated current block height to {self.current_block_height}")
+                logging.debug("Updated current block height to %s", self.current_block_height)
 
             self.latest_events[event_type] = event_body
-            with self.event_cv:
-                self.event_cv.notify()
+            self._event_flag(event_type).set()
 
         except Exception as e:
             logging.error("Error processing event: {}".format(str(e)))
 
+        if logged_out:
+            # Don't keep key material cached while logged out
+            self._wipe_authenticator()
+
         super().callback_handler(event)